@@ -1803,10 +1803,10 @@ if __name__ == '__main__':
             progress_file = savestate_util.SavableState(arguments.progress_file)
             progress_file.update(saved_data)
             del progress_file['no_progress']
-            progress_file.save_data()
+            progress_file.save_data(durable=True)
         else:
             saved_data.data_file = arguments.progress_file
-            saved_data.save_data()
+            saved_data.save_data(durable=True)
     else:
         os_util.local_print('You did not supply a progress_file, so I wont save data to a portable format.',
                             msg_verbosity=os_util.verbosity_level.warning, current_verbosity=arguments.verbose)
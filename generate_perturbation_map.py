@@ -604,7 +604,7 @@ if __name__ == '__main__':
 
     # Save the current solution data
     progress_data['thermograph']['last_solution'] = archive
-    progress_data.save_data()
+    progress_data.save_data(durable=True)
 
     if arguments.plot:
         import matplotlib
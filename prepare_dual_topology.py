@@ -4810,8 +4810,12 @@ if __name__ == '__main__':
                                     ''.format(each_file),
                                     msg_verbosity=os_util.verbosity_level.error, current_verbosity=arguments.verbosity)
 
-    progress_data.save_data()
-    shutil.copy2(progress_data.data_file, os.path.join(base_pert_dir, os.path.basename(progress_data.data_file)))
+    progress_data.save_data(durable=True)
+    for each_file in progress_data.get_data_files():
+        if os.path.isdir(each_file):
+            shutil.copytree(each_file, os.path.join(base_pert_dir, os.path.basename(each_file)), dirs_exist_ok=True)
+        else:
+            shutil.copy2(each_file, os.path.join(base_pert_dir, os.path.basename(each_file)))
 
     if arguments.output_packing == 'bin':
         with tempfile.SpooledTemporaryFile(mode='wb') as fh:
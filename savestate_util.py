@@ -21,13 +21,458 @@
 #
 #
 
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import io
+import mmap
 import pickle
+import struct
+import uuid
+try:
+    import zstandard
+except ImportError:
+    # Progress files will be saved uncompressed
+    zstandard = None
 
+import numpy
+import rdkit.Chem
+import rdkit.Chem.PropertyMol
+from rdkit.Chem.AllChem import Compute2DCoords, GenerateDepictionMatching2DStructure
+try:
+    from rdkit.Chem.Draw import MolDraw2DSVG
+except ImportError:
+    # RDKit built without drawing support, images will not be generated
+    MolDraw2DSVG = None
+# merge_topologies imports this module, so its functions are only looked up at call time
 import merge_topologies
 from all_classes import Namespace
 import os
 import os_util
-from shutil import copy2, copytree, rmtree
+from shutil import copyfileobj, copystat, copytree, rmtree, SameFileError
+from copy import copy
+
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+_PICKLE_BUFFER_SIZE = 1 << 20
+# Backup copies made by UserStorageDirectory run in background, see wait_pending_backups
+_backup_executor = ThreadPoolExecutor(max_workers=16)
+_pending_backups = []
+# Non-durable saves are committed in background by a single thread, so that they are still applied in order, see
+# SavableState.save_data
+_save_executor = ThreadPoolExecutor(max_workers=1)
+_pending_saves = []
+# First object in a progress file, followed by the id of its blob file (<progress file>.blobs), the number of data
+# blobs in it (which precede the out-of-band pickle buffers) and the compression used for blobs
+_STATE_HEADER = 'SavableState'
+# Outside of images, str and bytes at least this large are stored in the blob file, see _serialize_blobs
+_BLOB_MIN_SIZE = 1024
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Each record of the write-ahead log is a pickle preceded by its length
+_WAL_RECORD_HEADER = struct.Struct('<Q')
+# States are pickled in memory. Pickles up to this size are compressed in a single call and written at once, larger
+# ones are compressed as a stream, so that a compressed copy is not held in memory too, see SavableState.save_data
+_IN_MEMORY_PICKLE_LIMIT = 256 << 20
+# 2D depictions drawn by _render_svg, by SMILES and drawing options, least recently used first
+_svg_cache = OrderedDict()
+_SVG_CACHE_SIZE = 512
+
+
+def _property_mol_from_binary(binary_data):
+    """ Rebuild a PropertyMol pickled by _StatePickler
+
+    :param bytes binary_data: molecule binary, including its properties
+    :rtype: rdkit.Chem.PropertyMol.PropertyMol
+    """
+    return rdkit.Chem.PropertyMol.PropertyMol(rdkit.Chem.Mol(binary_data))
+
+
+class _StatePickler(pickle.Pickler):
+    """ Pickler which sends the binary data of rdkit.Chem.Mol and PropertyMol out-of-band, to be written to the blob
+    file. PropertyMol are stored along with all their properties
+    """
+
+    def reducer_override(self, obj):
+        if type(obj) is rdkit.Chem.Mol:
+            return rdkit.Chem.Mol, (pickle.PickleBuffer(obj.ToBinary()),)
+        elif type(obj) is rdkit.Chem.PropertyMol.PropertyMol:
+            return _property_mol_from_binary, \
+                (pickle.PickleBuffer(obj.ToBinary(rdkit.Chem.PropertyPickleOptions.AllProps)),)
+        return NotImplemented
+
+
+def _compressed_writer(file_handler):
+    """ Wrap file_handler in a zstd stream compressor, if zstandard is available
+
+    :param io.BufferedWriter file_handler: compressed data will be written to this file
+    :rtype: contextlib.AbstractContextManager
+    """
+
+    if zstandard is None:
+        return contextlib.nullcontext(file_handler)
+    return zstandard.ZstdCompressor(level=1, threads=-1).stream_writer(file_handler, closefd=False)
+
+
+def _decompressed_reader(file_handler):
+    """ Returns a reader to file_handler, which decompresses its contents if it is zstd-compressed
+
+    :param io.BufferedReader file_handler: file to be read
+    :rtype: io.BufferedReader
+    """
+
+    if file_handler.peek(len(_ZSTD_MAGIC))[:len(_ZSTD_MAGIC)] != _ZSTD_MAGIC:
+        return file_handler
+    if zstandard is None:
+        raise ImportError('zstandard is required to read the compressed file {}'.format(file_handler.name))
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(file_handler, closefd=False),
+                             buffer_size=_PICKLE_BUFFER_SIZE)
+
+
+def _serialize_blobs(state):
+    """ Split the image data and other large strings out of state. Every string in images, and any str or bytes of at
+    least _BLOB_MIN_SIZE elsewhere in ligands_data, is stored as a blob and replaced by a {'__blob__': index}
+    placeholder in a copy of state. Pickling the copy then does not go through these values, nor adds them to the
+    pickle memo. Only the containers holding blobs are copied.
+
+    :param dict state: data to be split
+    :rtype: tuple
+    :return: structural copy of state, list of blobs
+    """
+
+    blobs = []
+
+    def extract_blobs(data, min_size):
+        if isinstance(data, (str, bytes)) and len(data) >= min_size:
+            blobs.append(data.encode() if isinstance(data, str) else data)
+            return {'__blob__': len(blobs) - 1, 'type': 'str' if isinstance(data, str) else 'bytes'}
+        elif isinstance(data, dict):
+            new_data = None
+            for key, value in data.items():
+                new_value = extract_blobs(value, min_size)
+                if new_value is not value:
+                    if new_data is None:
+                        new_data = copy(data)
+                    new_data[key] = new_value
+            return data if new_data is None else new_data
+        return data
+
+    structural_dict = dict(state)
+    if isinstance(state.get('ligands_data'), dict):
+        structural_dict['ligands_data'] = {}
+        for each_name, each_entry in state['ligands_data'].items():
+            if isinstance(each_entry, dict):
+                if 'images' in each_entry:
+                    each_entry = copy(each_entry)
+                    each_entry['images'] = extract_blobs(each_entry['images'], 0)
+                each_entry = extract_blobs(each_entry, _BLOB_MIN_SIZE)
+            structural_dict['ligands_data'][each_name] = each_entry
+
+    return structural_dict, blobs
+
+
+def _restore_blobs(state, blobs):
+    """ Replace {'__blob__': index} placeholders created by _serialize_blobs with the blob data, in place
+
+    :param dict state: data read from a progress file
+    :param list blobs: blobs read from the blob file
+    """
+
+    def replace_blobs(data):
+        for key, value in data.items():
+            if isinstance(value, dict):
+                if '__blob__' in value:
+                    data[key] = blobs[value['__blob__']]
+                    if value.get('type', 'str') == 'str':
+                        data[key] = data[key].decode()
+                else:
+                    replace_blobs(value)
+
+    for each_entry in state.get('ligands_data', {}).values():
+        if isinstance(each_entry, dict):
+            replace_blobs(each_entry)
+
+
+def _write_blobs(blob_file, blobs, blob_id, durable=True):
+    """ Write blobs to a file, preceded by an id, their count and lengths. Whenever possible, data is written using a
+    single pwritev call, without copying the blobs to a contiguous buffer
+
+    :param str blob_file: write to this file
+    :param list blobs: bytes-like objects
+    :param bytes blob_id: 16-byte id, also stored in the progress file, so that a mismatched pair can be detected
+    :param bool durable: fsync the file after writing
+    """
+
+    blobs = [memoryview(each_blob).cast('B') for each_blob in blobs]
+    blobs.insert(0, memoryview(struct.pack('<16s{}Q'.format(len(blobs) + 1), blob_id, len(blobs),
+                                           *[each_blob.nbytes for each_blob in blobs])))
+
+    file_descriptor = os.open(blob_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if hasattr(os, 'pwritev'):
+            try:
+                iov_max = os.sysconf('SC_IOV_MAX')
+            except (ValueError, OSError):
+                iov_max = 1024
+            offset = 0
+            while blobs:
+                written = os.pwritev(file_descriptor, blobs[:iov_max], offset)
+                offset += written
+                # Drop what was written, pwritev may return before writing all the data
+                while blobs and written >= blobs[0].nbytes:
+                    written -= blobs.pop(0).nbytes
+                if written:
+                    blobs[0] = blobs[0][written:]
+        else:
+            with open(file_descriptor, 'wb', buffering=_PICKLE_BUFFER_SIZE, closefd=False) as file_handler:
+                for each_blob in blobs:
+                    file_handler.write(each_blob)
+        if durable:
+            os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+
+def _read_blobs(blob_file):
+    """ Read blobs written by _write_blobs
+
+    :param str blob_file: read from this file
+    :rtype: tuple
+    :return: blob file id, list of blobs
+    """
+
+    with open(blob_file, 'rb') as file_handler, \
+            mmap.mmap(file_handler.fileno(), 0, access=mmap.ACCESS_READ) as blob_data:
+        blob_id, num_blobs = struct.unpack_from('<16sQ', blob_data)
+        lengths = struct.unpack_from('<{}Q'.format(num_blobs), blob_data, 24)
+        blobs = []
+        offset = 24 + 8 * num_blobs
+        for each_length in lengths:
+            blobs.append(blob_data[offset:offset + each_length])
+            offset += each_length
+    return blob_id, blobs
+
+
+def _fast_copy(source, destination):
+    """ Copy a file and its metadata, like shutil.copy2. Contents are copied in kernel space using copy_file_range or
+    sendfile when available, falling back to a regular copy
+
+    :param str source: file to be copied
+    :param str destination: destination file name
+    """
+
+    try:
+        if os.path.samefile(source, destination):
+            raise SameFileError('{!r} and {!r} are the same file'.format(source, destination))
+    except FileNotFoundError:
+        # destination does not exist yet (or source does not exist, which will be raised by open below)
+        pass
+
+    with open(source, 'rb') as source_handler, open(destination, 'wb') as destination_handler:
+        source_fd = source_handler.fileno()
+        destination_fd = destination_handler.fileno()
+        file_size = os.fstat(source_fd).st_size
+        copied = 0
+        for copy_function in ['copy_file_range', 'sendfile']:
+            if copied >= file_size or not hasattr(os, copy_function):
+                continue
+            try:
+                while copied < file_size:
+                    # Both calls advance the position of destination_fd, so they can pick up where the other stopped
+                    if copy_function == 'copy_file_range':
+                        this_copy = os.copy_file_range(source_fd, destination_fd, file_size - copied, copied)
+                    else:
+                        this_copy = os.sendfile(destination_fd, source_fd, copied, file_size - copied)
+                    if this_copy == 0:
+                        break
+                    copied += this_copy
+            except OSError:
+                # Not supported for this pair of files (eg, different file systems on older kernels)
+                continue
+
+        # Copy anything left, also handles files changing size while being copied
+        source_handler.seek(copied)
+        destination_handler.seek(copied)
+        copyfileobj(source_handler, destination_handler)
+
+    copystat(source, destination)
+
+
+def _find_thermograph_file(thermograph_dir, run_key):
+    """ Find the file holding a thermograph run written by SavableState
+
+    :param str thermograph_dir: directory holding the thermograph runs
+    :param str run_key: name of the run
+    :rtype: str
+    """
+
+    for each_ext in ['.pkl.zst', '.pkl']:
+        run_file = os.path.join(thermograph_dir, run_key + each_ext)
+        if os.path.exists(run_file):
+            return run_file
+    raise FileNotFoundError('thermograph run {} not found in {}'.format(run_key, thermograph_dir))
+
+
+def _staged_copy(copy_function, source, destination):
+    """ Copy source to a unique staging name next to destination, then move it to destination, so that destination
+    never holds a partial copy. If destination is an existing directory (eg, from another backup made in the same
+    second), the copy is merged into it
+
+    :param function copy_function: function used to copy source, eg: _fast_copy or shutil.copytree
+    :param str source: file or directory to be copied
+    :param str destination: destination name
+    """
+
+    staging_name = '{}.{}.tmp'.format(destination, uuid.uuid4().hex)
+    copy_function(source, staging_name)
+    try:
+        os.replace(staging_name, destination)
+    except OSError:
+        if not (os.path.isdir(staging_name) and os.path.isdir(destination)):
+            raise
+        copytree(staging_name, destination, dirs_exist_ok=True)
+        rmtree(staging_name)
+
+
+def _staged_write(file_name, contents, mode):
+    """ Write contents to a unique staging name next to file_name, then rename it to file_name, so that file_name
+    never holds partial contents
+
+    :param str file_name: destination file name
+    :param [str, bytes] contents: data to be written
+    :param str mode: mode used to open the file, 'w' or 'wb'
+    """
+
+    staging_name = '{}.{}.tmp'.format(file_name, uuid.uuid4().hex)
+    with open(staging_name, mode=mode) as file_handler:
+        file_handler.write(contents)
+    os.replace(staging_name, file_name)
+
+
+def _fsync_file(file_name):
+    """ Flush a file to disk
+
+    :param str file_name: file to be flushed
+    """
+
+    file_descriptor = os.open(file_name, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+
+def _commit_save(replacements, stale_files=()):
+    """ Flush the files written by a save to disk, move each of them to its final name, in order, and remove files no
+    longer needed
+
+    :param list replacements: (temporary file, final name) pairs, the progress file must be the last one
+    :param list stale_files: files to be removed after the files are replaced
+    """
+
+    for temp_file, _ in replacements:
+        _fsync_file(temp_file)
+    for temp_file, final_file in replacements:
+        os.replace(temp_file, final_file)
+    for each_file in stale_files:
+        try:
+            os.remove(each_file)
+        except FileNotFoundError:
+            pass
+
+
+def wait_pending_saves():
+    """ Wait for the saves being committed in background to finish, raising the first error found, if any """
+
+    while _pending_saves:
+        _pending_saves.pop(0).result()
+
+
+def wait_pending_backups():
+    """ Wait for the backup copies made by UserStorageDirectory to finish, raising the first error found, if any """
+
+    while _pending_backups:
+        _pending_backups.pop(0).result()
+
+
+def _flush_pending_at_exit():
+    """ Wait for the saves being committed and the backups being copied in background and report the ones that
+    failed. Registered with atexit, so that failures are not lost when a script exits without calling flush
+    """
+
+    for pending_jobs, wait_function, message in [(_pending_saves, wait_pending_saves, 'save progress data'),
+                                                 (_pending_backups, wait_pending_backups, 'write a backup file')]:
+        while pending_jobs:
+            try:
+                wait_function()
+            except OSError as error:
+                os_util.local_print('Failed to {}. Error was: {}'.format(message, error),
+                                    msg_verbosity=os_util.verbosity_level.error)
+
+
+atexit.register(_flush_pending_at_exit)
+
+
+def _render_svg(mol, width, height, with_hs):
+    """ Draw a 2D depiction of a molecule to SVG. Results are cached by SMILES, so each molecule is only drawn once
+
+    :param rdkit.Chem.Mol mol: molecule to be drawn, a copy of it is used for drawing
+    :param int width: image width
+    :param int height: image height
+    :param bool with_hs: draw hydrogens, if False, RuntimeError will be raised if removing Hs breaks chirality
+    :rtype: str
+    """
+
+    cache_key = (rdkit.Chem.MolToSmiles(mol), width, height, with_hs)
+    try:
+        _svg_cache.move_to_end(cache_key)
+    except KeyError:
+        pass
+    else:
+        return _svg_cache[cache_key]
+
+    temp_mol = rdkit.Chem.Mol(mol)
+    draw_2d_svg = MolDraw2DSVG(width, height)
+    if with_hs:
+        draw_2d_svg.drawOptions().addStereoAnnotation = True
+    else:
+        temp_mol = rdkit.Chem.RemoveHs(temp_mol)
+    Compute2DCoords(temp_mol)
+    draw_2d_svg.DrawMolecule(temp_mol)
+    draw_2d_svg.FinishDrawing()
+
+    _svg_cache[cache_key] = draw_2d_svg.GetDrawingText()
+    if len(_svg_cache) > _SVG_CACHE_SIZE:
+        _svg_cache.popitem(last=False)
+    return _svg_cache[cache_key]
+
+
+def _atoms_outside_match(mol, match):
+    """ Get the indices of the atoms of mol which are not in a substructure match
+
+    :param rdkit.Chem.Mol mol: molecule
+    :param tuple match: indices of the matched atoms
+    :rtype: list
+    """
+
+    return numpy.setdiff1d(numpy.arange(mol.GetNumAtoms(), dtype=numpy.int32),
+                           numpy.fromiter(match, dtype=numpy.int32, count=len(match)), assume_unique=True).tolist()
+
+
+@functools.lru_cache(maxsize=256)
+def _prepare_core(core_smarts):
+    """ Parse a common core SMARTS and compute its 2D coordinates. Results are cached, as the same core is often shared
+    by many perturbations. The returned molecules must not be modified.
+
+    :param str core_smarts: common core SMARTS
+    :rtype: tuple
+    :return: core molecule, core molecule without Hs
+    """
+
+    core_mol = rdkit.Chem.MolFromSmarts(core_smarts)
+    core_mol.UpdatePropertyCache()
+    Compute2DCoords(core_mol)
+    return core_mol, rdkit.Chem.RemoveHs(core_mol)
 
 
 class SavableState(Namespace):
@@ -62,7 +507,7 @@ class SavableState(Namespace):
             }
         },
         'thermograph': {
-            'run_%d%m%Y_%H%M%S': {
+            'run_%d%m%Y_%H%M%S': {                             # Stored in data_file.thermograph, see get_thermograph
                 'runtype': runtype,                            # One of: ['optimal', 'star', 'wheel']
                 'bias': molecule_name                          # Map was biased towards a molecule, if any
                 'input_molecules': {
@@ -85,9 +530,13 @@ class SavableState(Namespace):
         """
 
         super().__init__()
+        # Key paths changed since the last save and the data_file last read or written. Set as plain attributes, so
+        # they are not stored as data
+        object.__setattr__(self, '_dirty_keys', set())
+        object.__setattr__(self, '_base_file', None)
 
         if input_file:
-            saved_data = self._read_data(input_file)
+            saved_data = self._read_data(input_file, verbosity=verbosity)
             for key, value in saved_data.items():
                 setattr(self, key, value)
             try:
@@ -97,6 +546,7 @@ class SavableState(Namespace):
                                         ''.format(input_file, self.data_file), current_verbosity=verbosity,
                                         msg_verbosity=os_util.verbosity_level.warning)
                 self.data_file = input_file
+                object.__setattr__(self, '_base_file', input_file)
             except AttributeError:
                 os_util.local_print('Progress file {} does not contain data_file data. Is it a progress file?'
                                     ''.format(input_file, self.data_file),
@@ -107,59 +557,342 @@ class SavableState(Namespace):
             # User did not supplied a name, generate one
             self.data_file = 'savedata_{}.pkl'.format(os_util.date_fmt())
 
-    def _read_data(self, input_file):
-        """ Reads a pickle file, returns its object or None on fail
+    def _read_data(self, input_file, verbosity=0):
+        """ Reads a pickle file and replays its write-ahead log, if any, returns its object or None on fail
 
         :param str input_file: save result to this file
+        :param int verbosity: control verbosity level
         :rtype: dict
         """
 
+        wait_pending_saves()
         try:
-            with open(input_file, 'rb') as file_handler:
+            with open(input_file, 'rb', buffering=_PICKLE_BUFFER_SIZE) as file_handler:
+                file_handler = _decompressed_reader(file_handler)
                 raw_data = pickle.load(file_handler)
+                if isinstance(raw_data, tuple) and raw_data[0] == _STATE_HEADER:
+                    # Current format, data follows the header and may use a blob file. Older progress files have the
+                    # data right away
+                    _, blob_id, num_data_blobs, blob_compression = raw_data
+                    blob_file = '{}.blobs'.format(input_file)
+                    try:
+                        stored_blob_id, blobs = _read_blobs(blob_file)
+                    except FileNotFoundError:
+                        os_util.local_print('Blob file {} needed by the progress file {} was not found. Progress '
+                                            'files must be moved or copied along with their .blobs file and '
+                                            '.thermograph directory.'.format(blob_file, input_file),
+                                            msg_verbosity=os_util.verbosity_level.error, current_verbosity=verbosity)
+                        raise ValueError('Blob file {} not found'.format(blob_file))
+                    if stored_blob_id.hex() != blob_id:
+                        os_util.local_print('Blob file {} was not saved along with the progress file {}. Progress '
+                                            'files must be moved or copied along with their .blobs file and '
+                                            '.thermograph directory.'.format(blob_file, input_file),
+                                            msg_verbosity=os_util.verbosity_level.error, current_verbosity=verbosity)
+                        raise ValueError('Blob file {} does not match {}'.format(blob_file, input_file))
+                    if blob_compression == 'zstd':
+                        if zstandard is None:
+                            raise ImportError('zstandard is required to read the compressed file {}'
+                                              ''.format(blob_file))
+                        decompressor = zstandard.ZstdDecompressor()
+                        blobs = [decompressor.decompress(each_blob) for each_blob in blobs]
+                    raw_data = pickle.load(file_handler, buffers=blobs[num_data_blobs:])
+                    _restore_blobs(raw_data, blobs)
+            self._replay_wal(raw_data, '{}.wal'.format(input_file), verbosity=verbosity)
         except FileNotFoundError:
             # input_file does not exist, create file and save data to it
             self.data_file = input_file
-            with open(input_file, 'wb') as file_handler:
-                pickle.dump(self.__dict__, file_handler)
-            return self.__dict__
+            self.save_data(durable=True)
+            return dict(self)
         else:
             return raw_data
 
-    def save_data(self, output_file='', verbosity=0):
-        """ Save state to a pickle file
+    @staticmethod
+    def _replay_wal(data, wal_file, verbosity=0):
+        """ Apply the records of a write-ahead log to data, in place. An incomplete last record (eg, from a crash during
+        save) is ignored and truncated from the log, so that the next records can be appended after the valid ones
+
+        :param dict data: data read from the base pickle file
+        :param str wal_file: write-ahead log file
+        :param int verbosity: controls verbosity level
+        """
+
+        try:
+            with open(wal_file, 'rb', buffering=_PICKLE_BUFFER_SIZE) as file_handler:
+                file_size = os.fstat(file_handler.fileno()).st_size
+                valid_size = 0
+                while valid_size < file_size:
+                    try:
+                        record_header = file_handler.read(_WAL_RECORD_HEADER.size)
+                        if len(record_header) < _WAL_RECORD_HEADER.size:
+                            raise EOFError('incomplete record header')
+                        record_size, = _WAL_RECORD_HEADER.unpack(record_header)
+                        if record_size > file_size - file_handler.tell():
+                            raise EOFError('incomplete record')
+                        key_path, value = pickle.loads(file_handler.read(record_size))
+                    except Exception as error:
+                        os_util.local_print('Ignoring an incomplete record at the end of {}, it will be removed '
+                                            '(error was: {})'.format(wal_file, error),
+                                            msg_verbosity=os_util.verbosity_level.warning, current_verbosity=verbosity)
+                        break
+                    this_level = data
+                    for each_key in key_path[:-1]:
+                        this_level = this_level.setdefault(each_key, {})
+                    this_level[key_path[-1]] = value
+                    valid_size = file_handler.tell()
+        except FileNotFoundError:
+            return
+
+        if valid_size < file_size:
+            try:
+                os.truncate(wal_file, valid_size)
+            except OSError as error:
+                os_util.local_print('Could not remove the incomplete record from {}. Error was: {}'
+                                    ''.format(wal_file, error),
+                                    msg_verbosity=os_util.verbosity_level.warning, current_verbosity=verbosity)
+
+    def _mark_dirty(self, *key_path):
+        """ Mark an entry as changed, so that it will be written by the next incremental save
+
+        :param key_path: keys to the changed entry, from the top level
+        """
+        self._dirty_keys.add(key_path)
+
+    def flush(self, verbosity=0):
+        """ Wait for pending saves to finish, see flush_pending_saves. Backups made by UserStorageDirectory are waited
+        for by UserStorageDirectory.flush
+
+        :param int verbosity: controls verbosity level
+        """
+
+        self.flush_pending_saves(verbosity=verbosity)
+
+    @staticmethod
+    def flush_pending_saves(verbosity=0):
+        """ Wait for the saves being committed in background to finish, see save_data
+
+        :param int verbosity: controls verbosity level
+        """
+
+        try:
+            wait_pending_saves()
+        except OSError as error:
+            os_util.local_print('Failed to save progress data. Error was: {}'.format(error),
+                                current_verbosity=verbosity, msg_verbosity=os_util.verbosity_level.error)
+            raise
+
+    def compact(self, durable=True, verbosity=0):
+        """ Rewrite the whole state to data_file and discard its write-ahead log
+
+        :param bool durable: flush the data to disk and replace the output file before returning
+        :param int verbosity: controls verbosity level
+        :rtype: bool
+        """
+        return self.save_data(durable=durable, verbosity=verbosity)
+
+    def save_data(self, output_file='', durable=False, incremental=False, verbosity=0):
+        """ Save state to a pickle file. Data is written to a temporary file next to the output file, which is then
+        flushed to disk and atomically replaces it. Unless durable is set, this last step runs in background and this
+        function returns right after writing the data; use flush_pending_saves to wait for it.
 
         :param str output_file: save result to this file
+        :param bool durable: flush the data to disk and replace the output file before returning
+        :param bool incremental: only append entries marked as changed to the write-ahead log of data_file, if
+                                 possible. Changes not done by the update_* methods are only saved by a full save.
         :param int verbosity: controls verbosity level
         :rtype: bool
         """
 
+        # Also makes sure the previous save of this file is in place before writing over its temporary file
+        self.flush_pending_saves(verbosity=verbosity)
+
         if output_file != '':
             self.data_file = output_file
 
+        if incremental and self._base_file == self.data_file:
+            return self._append_wal(durable=durable, verbosity=verbosity)
+
+        temp_file = '{}.tmp.{}'.format(self.data_file, os.getpid())
+        blob_file = '{}.blobs'.format(self.data_file)
+        temp_blob_file = '{}.tmp.{}'.format(blob_file, os.getpid())
+        # Stored in both files, so that a progress file read along with a blob file from another save is detected
+        blob_id = uuid.uuid4().bytes
         try:
-            with open('.temp_pickle_test.pkl', 'wb') as file_handler:
-                pickle.dump(self.__dict__, file_handler)
-                os.fsync(file_handler.fileno())
+            self._externalize_thermograph(verbosity=verbosity)
+            structural_dict, blobs = _serialize_blobs(self)
+            num_data_blobs = len(blobs)
+            state_header = (_STATE_HEADER, blob_id.hex(), num_data_blobs,
+                            'zstd' if zstandard is not None else None)
+            # Pickling issues many small writes, so collect them in memory and write the file at once
+            with io.BytesIO() as pickle_buffer:
+                pickle.dump(state_header, pickle_buffer, protocol=_PICKLE_PROTOCOL)
+                _StatePickler(pickle_buffer, protocol=_PICKLE_PROTOCOL,
+                              buffer_callback=lambda each_buffer: blobs.append(each_buffer.raw())
+                              ).dump(structural_dict)
+                # A buffered writer makes sure all data is written, even if the underlying write is short
+                with pickle_buffer.getbuffer() as pickle_data, \
+                        open(temp_file, 'wb', buffering=_PICKLE_BUFFER_SIZE) as file_handler:
+                    if zstandard is not None and pickle_buffer.tell() <= _IN_MEMORY_PICKLE_LIMIT:
+                        file_handler.write(zstandard.ZstdCompressor(level=1).compress(pickle_data))
+                    else:
+                        with _compressed_writer(file_handler) as stream_handler:
+                            stream_handler.write(pickle_data)
+            if zstandard is not None:
+                compressor = zstandard.ZstdCompressor(level=1)
+                blobs = [compressor.compress(each_blob) for each_blob in blobs]
+            # Always written, even if empty, so that a missing blob file can be told apart when reading
+            _write_blobs(temp_blob_file, blobs, blob_id, durable=False)
         except (IOError, FileNotFoundError):
             os_util.local_print('Could not save data to {}'.format(self.data_file), current_verbosity=verbosity,
                                 msg_verbosity=os_util.verbosity_level.error)
             raise SystemExit(1)
         else:
-            try:
-                os.replace('.temp_pickle_test.pkl', self.data_file)
-            except FileNotFoundError as error:
-                os_util.local_print('Failed to save progress data to file {}'.format(self.data_file),
-                                    current_verbosity=verbosity,
-                                    msg_verbosity=os_util.verbosity_level.error)
-                raise FileNotFoundError(error)
+            # The blob file is replaced first, data_file being replaced commits the save
+            commit_args = ([(temp_blob_file, blob_file), (temp_file, self.data_file)],
+                           ['{}.wal'.format(self.data_file)])
+            if durable:
+                try:
+                    _commit_save(*commit_args)
+                except FileNotFoundError as error:
+                    os_util.local_print('Failed to save progress data to file {}'.format(self.data_file),
+                                        current_verbosity=verbosity,
+                                        msg_verbosity=os_util.verbosity_level.error)
+                    raise FileNotFoundError(error)
+            else:
+                _pending_saves.append(_save_executor.submit(_commit_save, *commit_args))
+            self._dirty_keys.clear()
+            object.__setattr__(self, '_base_file', self.data_file)
             os_util.local_print('Saved data to {}'.format(self.data_file), current_verbosity=verbosity,
                                 msg_verbosity=os_util.verbosity_level.debug)
             return True
 
-    @property
-    def __dict__(self):
-        return dict(self)
+    def get_data_files(self):
+        """ List the files and directories holding the saved state: data_file and any auxiliary file it needs
+
+        :rtype: list
+        """
+
+        self.flush_pending_saves()
+        data_files = [self.data_file]
+        for each_file in ['{}.blobs'.format(self.data_file), '{}.wal'.format(self.data_file),
+                          '{}.thermograph'.format(self.data_file)]:
+            if os.path.exists(each_file):
+                data_files.append(each_file)
+        return data_files
+
+    def _externalize_thermograph(self, verbosity=0):
+        """ Write each thermograph run to its own file in data_file.thermograph and keep only a {'__ref__': run_key}
+        entry in the state. Runs are written once, so that past runs are not rewritten by every save
+
+        :param int verbosity: controls verbosity level
+        """
+
+        thermograph = self.get('thermograph')
+        if not isinstance(thermograph, dict):
+            return
+
+        thermograph_dir = '{}.thermograph'.format(self.data_file)
+        for run_key, run_data in thermograph.items():
+            if not run_key.startswith('run_'):
+                continue
+            if isinstance(run_data, dict) and '__ref__' in run_data:
+                if self._base_file not in [None, self.data_file]:
+                    # Saving to a new file, take the runs stored by the previous one along
+                    try:
+                        run_file = _find_thermograph_file('{}.thermograph'.format(self._base_file), run_key)
+                    except FileNotFoundError as error:
+                        os_util.local_print('Could not copy the thermograph run {} to {}, it will not be available '
+                                            'from this file. Error was: {}'.format(run_key, thermograph_dir, error),
+                                            msg_verbosity=os_util.verbosity_level.warning,
+                                            current_verbosity=verbosity)
+                        continue
+                    os.makedirs(thermograph_dir, exist_ok=True)
+                    _fast_copy(run_file, os.path.join(thermograph_dir, os.path.basename(run_file)))
+                continue
+
+            os.makedirs(thermograph_dir, exist_ok=True)
+            run_file = os.path.join(thermograph_dir, run_key + ('.pkl.zst' if zstandard is not None else '.pkl'))
+            temp_file = '{}.tmp.{}'.format(run_file, os.getpid())
+            with open(temp_file, 'wb', buffering=0) as raw_handler, \
+                    io.BufferedWriter(raw_handler, buffer_size=_PICKLE_BUFFER_SIZE) as file_handler:
+                with _compressed_writer(file_handler) as stream_handler:
+                    pickle.dump(run_data, stream_handler, protocol=_PICKLE_PROTOCOL)
+                file_handler.flush()
+                # Runs are only written once, always make sure they are on disk before data_file references them
+                os.fsync(raw_handler.fileno())
+            os.replace(temp_file, run_file)
+            thermograph[run_key] = {'__ref__': run_key}
+
+    def get_thermograph(self, run_key):
+        """ Get data of a thermograph run, loading it from data_file.thermograph if needed
+
+        :param str run_key: name of the run, eg: run_%d%m%Y_%H%M%S
+        :rtype: dict
+        """
+
+        run_data = self.thermograph[run_key]
+        if isinstance(run_data, dict) and '__ref__' in run_data:
+            thermograph_dir = '{}.thermograph'.format(self._base_file if self._base_file else self.data_file)
+            run_file = _find_thermograph_file(thermograph_dir, run_data['__ref__'])
+            with open(run_file, 'rb', buffering=_PICKLE_BUFFER_SIZE) as file_handler:
+                run_data = pickle.load(_decompressed_reader(file_handler))
+        return run_data
+
+    def _append_wal(self, durable=True, verbosity=0):
+        """ Append the entries marked as changed to the write-ahead log of data_file
+
+        :param bool durable: flush the log to disk before returning, otherwise this is done in background
+        :param int verbosity: controls verbosity level
+        :rtype: bool
+        """
+
+        if not self._dirty_keys:
+            return True
+
+        wal_file = '{}.wal'.format(self.data_file)
+        try:
+            with open(wal_file, 'ab', buffering=0) as raw_handler, \
+                    io.BufferedWriter(raw_handler, buffer_size=_PICKLE_BUFFER_SIZE) as file_handler:
+                for each_path in self._dirty_keys:
+                    this_value = self
+                    try:
+                        for each_key in each_path:
+                            this_value = this_value[each_key]
+                    except KeyError:
+                        # Entry was removed after being marked, a full save is needed to reflect that
+                        continue
+                    record = pickle.dumps((each_path, this_value), protocol=_PICKLE_PROTOCOL)
+                    file_handler.write(_WAL_RECORD_HEADER.pack(len(record)))
+                    file_handler.write(record)
+                file_handler.flush()
+                if durable:
+                    os.fsync(raw_handler.fileno())
+            if not durable:
+                _pending_saves.append(_save_executor.submit(_fsync_file, wal_file))
+        except (IOError, FileNotFoundError):
+            os_util.local_print('Could not save data to {}'.format(wal_file), current_verbosity=verbosity,
+                                msg_verbosity=os_util.verbosity_level.error)
+            raise SystemExit(1)
+
+        os_util.local_print('Appended {} entries to {}'.format(len(self._dirty_keys), wal_file),
+                            current_verbosity=verbosity, msg_verbosity=os_util.verbosity_level.debug)
+        self._dirty_keys.clear()
+        return True
+
+    def __reduce_ex__(self, protocol):
+        return SavableState._from_mapping, (dict(self),)
+
+    @classmethod
+    def _from_mapping(cls, data):
+        """ Create a SavableState holding data, without reading any file
+
+        :param dict data: state data
+        :rtype: SavableState
+        """
+
+        new_state = cls()
+        new_state.clear()
+        new_state.update(data)
+        return new_state
 
     def update_mol_image(self, mol_name, save=False, verbosity=0):
         """ Generate mol images, if needed
@@ -169,10 +902,6 @@ class SavableState(Namespace):
         :param int verbosity: controls verbosity level
         """
 
-        import rdkit.Chem
-        from rdkit.Chem.Draw import MolDraw2DSVG
-        from rdkit.Chem.AllChem import Compute2DCoords
-
         try:
             this_mol = self.ligands_data[mol_name]['molecule']
         except KeyError:
@@ -180,35 +909,31 @@ class SavableState(Namespace):
                                 ''.format(mol_name),
                                 msg_verbosity=os_util.verbosity_level.warning, current_verbosity=verbosity)
             return False
-        self.ligands_data[mol_name].setdefault('images', {})
-
-        if not {'2d_hs', '2d_nohs'}.issubset(self.ligands_data[mol_name]['images']):
-            draw_2d_svg = MolDraw2DSVG(300, 300)
-            temp_mol = rdkit.Chem.Mol(this_mol)
-            Compute2DCoords(temp_mol)
-            draw_2d_svg.drawOptions().addStereoAnnotation=True
-            draw_2d_svg.DrawMolecule(temp_mol)
-            draw_2d_svg.FinishDrawing()
-            svg_data_hs = draw_2d_svg.GetDrawingText()
-
-            temp_mol = rdkit.Chem.RemoveHs(temp_mol)
-            Compute2DCoords(temp_mol)
-            draw_2d_svg = MolDraw2DSVG(300, 300)
+
+        images = self.ligands_data[mol_name].get('images')
+        if not images or '2d_hs' not in images or '2d_nohs' not in images:
+            if MolDraw2DSVG is None:
+                os_util.local_print('RDKit drawing code is not available. Cannot draw molecule {} to a 2D svg'
+                                    ''.format(mol_name),
+                                    msg_verbosity=os_util.verbosity_level.warning, current_verbosity=verbosity)
+                return False
+
+            svg_data_hs = _render_svg(this_mol, 300, 300, True)
             try:
-                draw_2d_svg.DrawMolecule(temp_mol)
+                svg_data_no_hs = _render_svg(this_mol, 300, 300, False)
             except RuntimeError:
                 os_util.local_print('Removing hydrogens of {} would break chirality. I will no generate a '
                                     'representation without Hs'.format(mol_name),
                                     msg_verbosity=os_util.verbosity_level.debug, current_verbosity=verbosity)
                 svg_data_no_hs = svg_data_hs
-            else:
-                draw_2d_svg.FinishDrawing()
-                svg_data_no_hs = draw_2d_svg.GetDrawingText()
 
-            self.ligands_data[mol_name]['images'].update({'2d_hs': svg_data_hs, '2d_nohs': svg_data_no_hs})
+            self.ligands_data[mol_name].setdefault('images', {}).update({'2d_hs': svg_data_hs,
+                                                                         '2d_nohs': svg_data_no_hs})
+            self._mark_dirty('ligands_data', mol_name, 'images', '2d_hs')
+            self._mark_dirty('ligands_data', mol_name, 'images', '2d_nohs')
 
         if save:
-            self.save_data()
+            self.save_data(incremental=True)
 
     def update_pertubation_image(self, mol_a_name, mol_b_name, core_smarts=None, save=False, verbosity=0, **kwargs):
         """ Generate mol images describing a perturbation between the ligand pair
@@ -225,16 +950,15 @@ class SavableState(Namespace):
         self.ligands_data[mol_b_name].setdefault('images', {})
         self.ligands_data[mol_b_name]['images'].setdefault('perturbations', {})
 
-        import rdkit.Chem
         this_mol_a = rdkit.Chem.Mol(self.ligands_data[mol_a_name]['molecule'])
         this_mol_b = rdkit.Chem.Mol(self.ligands_data[mol_b_name]['molecule'])
 
         if core_smarts is None:
             # Get core_smarts using find_mcs
-            from merge_topologies import find_mcs
             this_mol_a.RemoveAllConformers()
             this_mol_b.RemoveAllConformers()
-            core_smarts = find_mcs([this_mol_a, this_mol_b], savestate=self, verbosity=verbosity, **kwargs).smartsString
+            core_smarts = merge_topologies.find_mcs([this_mol_a, this_mol_b], savestate=self, verbosity=verbosity,
+                                                    **kwargs).smartsString
 
         try:
             # Test whether the correct data structure is already present
@@ -248,13 +972,13 @@ class SavableState(Namespace):
         else:
             return None
 
-        from rdkit.Chem.Draw import MolDraw2DSVG
-        from rdkit.Chem.AllChem import Compute2DCoords, GenerateDepictionMatching2DStructure
+        if MolDraw2DSVG is None:
+            os_util.local_print('RDKit drawing code is not available. Cannot draw perturbation {} -> {} to a 2D svg'
+                                ''.format(mol_a_name, mol_b_name),
+                                msg_verbosity=os_util.verbosity_level.warning, current_verbosity=verbosity)
+            return False
 
-        core_mol = rdkit.Chem.MolFromSmarts(core_smarts)
-        # print(core_smarts)
-        core_mol.UpdatePropertyCache()
-        Compute2DCoords(core_mol)
+        core_mol, core_mol_noh = _prepare_core(core_smarts)
 
         for each_name, each_mol, other_mol in zip([mol_a_name, mol_b_name],
                                                   [this_mol_a, this_mol_b],
@@ -271,8 +995,9 @@ class SavableState(Namespace):
                 draw_2d_svg.FinishDrawing()
                 svg_data_hs = draw_2d_svg.GetDrawingText()
             else:
-                not_common_atoms = [i.GetIdx() for i in each_mol.GetAtoms() if i.GetIdx() not in common_atoms]
-                draw_2d_svg.DrawMolecule(each_mol, legend=each_name, highlightAtoms=not_common_atoms)
+                # Highlight atoms outside the first match to the core
+                draw_2d_svg.DrawMolecule(each_mol, legend=each_name,
+                                         highlightAtoms=_atoms_outside_match(each_mol, common_atoms[0]))
                 draw_2d_svg.FinishDrawing()
                 svg_data_hs = draw_2d_svg.GetDrawingText()
 
@@ -280,25 +1005,25 @@ class SavableState(Namespace):
             draw_2d_svg = MolDraw2DSVG(300, 150)
             draw_2d_svg.drawOptions().addStereoAnnotation = True
             each_mol = rdkit.Chem.RemoveHs(each_mol)
-            common_atoms = merge_topologies.get_substruct_matches_fallback(each_mol,
-                                                                           rdkit.Chem.RemoveHs(core_mol),
-                                                                           die_on_error=False,
+            common_atoms = merge_topologies.get_substruct_matches_fallback(each_mol, core_mol_noh, die_on_error=False,
                                                                            verbosity=verbosity)
             if not common_atoms:
                 draw_2d_svg.DrawMolecule(each_mol, legend=each_name)
                 draw_2d_svg.FinishDrawing()
                 svg_data_nohs = draw_2d_svg.GetDrawingText()
             else:
-                not_common_atoms = [i.GetIdx() for i in each_mol.GetAtoms() if i.GetIdx() not in common_atoms]
-                draw_2d_svg.DrawMolecule(each_mol, legend=each_name, highlightAtoms=not_common_atoms)
+                # Highlight atoms outside the first match to the core
+                draw_2d_svg.DrawMolecule(each_mol, legend=each_name,
+                                         highlightAtoms=_atoms_outside_match(each_mol, common_atoms[0]))
                 draw_2d_svg.FinishDrawing()
                 svg_data_nohs = draw_2d_svg.GetDrawingText()
 
             perturbation_imgs = self.ligands_data[each_name]['images']['perturbations']
             perturbation_imgs.setdefault(other_mol, {})[core_smarts] = {'2d_hs': svg_data_hs, '2d_nohs': svg_data_nohs}
+            self._mark_dirty('ligands_data', each_name, 'images', 'perturbations', other_mol, core_smarts)
 
         if save:
-            self.save_data()
+            self.save_data(incremental=True)
 
 
 class UserStorageDirectory:
@@ -333,7 +1058,7 @@ class UserStorageDirectory:
             pass
 
     def create_file(self, file_name, contents, verbosity=0):
-        """ Create file in storage dir
+        """ Create file in storage dir. The timestamped backup is written in background, use flush to wait for it
 
         :param str file_name: name of file to be created
         :param [str, bytes] contents: save this data to file
@@ -351,15 +1076,17 @@ class UserStorageDirectory:
         with open(os.path.join(self.path, file_name), mode=mode) as fh:
             fh.write(contents)
 
-        # Save a backup of the file with and timestamp
-        backup_name = os.path.join(self.path, '{}_{}{}'.format(os.path.basename(file_name), os_util.date_fmt(),
-                                                               os.path.splitext(file_name)))
-        copy2(os.path.join(self.path, file_name), backup_name)
+        # Save a backup of the file with and timestamp. It is written from contents, as the file itself may already be
+        # rewritten by the time the backup runs
+        file_root, file_ext = os.path.splitext(file_name)
+        backup_name = os.path.join(self.path, '{}_{}{}'.format(os.path.basename(file_root), os_util.date_fmt(),
+                                                               file_ext))
+        _pending_backups.append(_backup_executor.submit(_staged_write, backup_name, contents, mode))
 
         return True
 
     def store_file(self, source, dest_file='', verbosity=0):
-        """ Copy file or dir to storage dir
+        """ Copy file or dir to storage dir. The timestamped backup is copied in background, use flush to wait for it
 
         :param str source: file to be copied
         :param str dest_file: new file name, default: use source_file name
@@ -378,18 +1105,19 @@ class UserStorageDirectory:
                                     msg_verbosity=os_util.verbosity_level.error, current_verbosity=verbosity)
                 raise ValueError('invalid source name')
 
-        backup_name = os.path.join(self.path, '{}_{}{}'.format(os.path.basename(dest_file), os_util.date_fmt(),
-                                                               os.path.splitext(dest_file)))
+        file_root, file_ext = os.path.splitext(dest_file)
+        backup_name = os.path.join(self.path, '{}_{}{}'.format(os.path.basename(file_root), os_util.date_fmt(),
+                                                               file_ext))
         try:
-            copy2(source, os.path.join(self.path, dest_file))
-            copy2(source, backup_name)
+            _fast_copy(source, os.path.join(self.path, dest_file))
+            _pending_backups.append(_backup_executor.submit(_staged_copy, _fast_copy, source, backup_name))
         except IsADirectoryError:
-            try:
-                copytree(source, os.path.join(self.path, dest_file))
-            except FileExistsError:
-                rmtree(os.path.join(self.path, dest_file))
-                copytree(source, os.path.join(self.path, dest_file))
-            finally:
-                copytree(source, os.path.join(self.path, backup_name))
+            copytree(source, os.path.join(self.path, dest_file), dirs_exist_ok=True)
+            _pending_backups.append(_backup_executor.submit(_staged_copy, copytree, source, backup_name))
 
         return True
+
+    @staticmethod
+    def flush():
+        """ Wait for pending backup copies to finish, see wait_pending_backups """
+        wait_pending_backups()
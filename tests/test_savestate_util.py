@@ -0,0 +1,443 @@
+#! /usr/bin/env python3
+#
+#  test_savestate_util.py
+#
+#  Copyright 2019 Luan Carvalho Martins <luancarvalho@ufmg.br>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import os
+import pickle
+import numpy
+import re
+import shutil
+from tempfile import TemporaryDirectory
+import rdkit.Chem
+import rdkit.Chem.PropertyMol
+import savestate_util
+
+
+def make_ligands_data():
+    molecule = rdkit.Chem.PropertyMol.PropertyMol(rdkit.Chem.AddHs(rdkit.Chem.MolFromSmiles('c1ccccc1O')))
+    molecule.SetProp('ligand_name', 'phenol')
+    return {'phenol': {'molecule': molecule,
+                       'topology': ['phenol.top'],
+                       'images': {'2d_hs': '<svg>with Hs</svg>', '2d_nohs': '<svg>without Hs</svg>'},
+                       'notes': 'a' * 2048}}
+
+
+def check_ligands_data(ligands_data):
+    assert set(ligands_data) == {'phenol'}
+    molecule = ligands_data['phenol']['molecule']
+    assert isinstance(molecule, rdkit.Chem.PropertyMol.PropertyMol)
+    assert rdkit.Chem.MolToSmiles(molecule) == rdkit.Chem.MolToSmiles(make_ligands_data()['phenol']['molecule'])
+    assert molecule.GetProp('ligand_name') == 'phenol'
+    assert ligands_data['phenol']['topology'] == ['phenol.top']
+    assert ligands_data['phenol']['images'] == {'2d_hs': '<svg>with Hs</svg>', '2d_nohs': '<svg>without Hs</svg>'}
+    assert ligands_data['phenol']['notes'] == 'a' * 2048
+
+
+def test_read_legacy_file():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'legacy.pkl')
+        with open(data_file, 'wb') as fh:
+            pickle.dump({'data_file': data_file, 'ligands_data': make_ligands_data()}, fh)
+        check_ligands_data(savestate_util.SavableState(data_file).ligands_data)
+
+
+def test_save_and_load():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data['mcs_dict'] = {frozenset(['CCO', 'CCN']): 'CC'}
+        saved_data.save_data()
+        saved_data.flush()
+        assert len([each_file for each_file in saved_data.get_data_files() if each_file.endswith('.blobs')]) == 1
+
+        loaded_data = savestate_util.SavableState(data_file)
+        check_ligands_data(loaded_data.ligands_data)
+        assert loaded_data.mcs_dict == {frozenset(['CCO', 'CCN']): 'CC'}
+
+        # Saving again replaces the blob file
+        loaded_data.save_data(durable=True)
+        assert len([each_file for each_file in os.listdir(tempdir) if each_file.endswith('.blobs')]) == 1
+
+
+def test_incremental_save():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data.save_data(durable=True)
+
+        perturbation_imgs = {'CC': {'2d_hs': '<svg>a</svg>', '2d_nohs': '<svg>b</svg>'}}
+        saved_data.ligands_data['phenol']['images']['perturbations'] = {'benzene': perturbation_imgs}
+        saved_data._mark_dirty('ligands_data', 'phenol', 'images', 'perturbations')
+        saved_data.save_data(incremental=True, durable=True)
+        assert os.path.isfile('{}.wal'.format(data_file))
+
+        loaded_data = savestate_util.SavableState(data_file)
+        assert loaded_data.ligands_data['phenol']['images']['perturbations'] == {'benzene': perturbation_imgs}
+
+        loaded_data.compact()
+        assert not os.path.exists('{}.wal'.format(data_file))
+        loaded_data = savestate_util.SavableState(data_file)
+        assert loaded_data.ligands_data['phenol']['images']['perturbations'] == {'benzene': perturbation_imgs}
+        del loaded_data.ligands_data['phenol']['images']['perturbations']
+        check_ligands_data(loaded_data.ligands_data)
+
+
+def test_incomplete_wal_record():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        wal_file = '{}.wal'.format(data_file)
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data.save_data(durable=True)
+
+        for each_name, each_tail in [('first', b'\x10\x00\x00'), ('second', b'\x10\x00\x00\x00\x00\x00\x00\x00\x80')]:
+            saved_data.ligands_data['phenol']['images'][each_name] = '<svg>{}</svg>'.format(each_name)
+            saved_data._mark_dirty('ligands_data', 'phenol', 'images', each_name)
+            saved_data.save_data(incremental=True, durable=True)
+            valid_size = os.path.getsize(wal_file)
+            # Simulate a crash during an append
+            with open(wal_file, 'ab') as fh:
+                fh.write(each_tail)
+
+            loaded_data = savestate_util.SavableState(data_file, verbosity=-1)
+            assert loaded_data.ligands_data['phenol']['images'][each_name] == '<svg>{}</svg>'.format(each_name)
+            assert os.path.getsize(wal_file) == valid_size
+
+        # Both records appended after the incomplete ones were kept
+        loaded_data = savestate_util.SavableState(data_file)
+        assert loaded_data.ligands_data['phenol']['images']['first'] == '<svg>first</svg>'
+        assert loaded_data.ligands_data['phenol']['images']['second'] == '<svg>second</svg>'
+
+
+def test_blob_types():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data.ligands_data['phenol']['images']['2d_hs'] = numpy.str_('<svg>with Hs</svg>')
+        saved_data.ligands_data['phenol']['notes'] = numpy.str_('a' * 2048)
+        saved_data.ligands_data['phenol']['raw_data'] = b'b' * 2048
+        saved_data.save_data(durable=True)
+
+        loaded_data = savestate_util.SavableState(data_file)
+        assert loaded_data.ligands_data['phenol'].pop('raw_data') == b'b' * 2048
+        assert isinstance(loaded_data.ligands_data['phenol']['images']['2d_hs'], str)
+        assert isinstance(loaded_data.ligands_data['phenol']['notes'], str)
+        check_ligands_data(loaded_data.ligands_data)
+
+
+def test_thermograph_runs():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        run_data = {'runtype': 'star', 'bias': 'phenol', 'best_solution': [('phenol', 'benzene')]}
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['thermograph'] = {'run_01': run_data, 'last_solution': {'runtype': 'star'}}
+        saved_data.save_data(durable=True)
+
+        # Runs are moved to data_file.thermograph, other entries are kept
+        assert saved_data.thermograph['run_01'] == {'__ref__': 'run_01'}
+        assert saved_data.thermograph['last_solution'] == {'runtype': 'star'}
+        assert os.listdir('{}.thermograph'.format(data_file)) in [['run_01.pkl'], ['run_01.pkl.zst']]
+        assert '{}.thermograph'.format(data_file) in saved_data.get_data_files()
+        assert saved_data.get_thermograph('run_01') == run_data
+        assert saved_data.get_thermograph('last_solution') == {'runtype': 'star'}
+        assert savestate_util.SavableState(data_file).get_thermograph('run_01') == run_data
+
+        # Saving to a new file copies the runs
+        new_file = os.path.join(tempdir, 'new_progress.pkl')
+        saved_data.save_data(output_file=new_file, durable=True)
+        shutil.rmtree('{}.thermograph'.format(data_file))
+        new_data = savestate_util.SavableState(new_file)
+        assert new_data.get_thermograph('run_01') == run_data
+
+        # A run missing from the previous file does not prevent saving to another one
+        shutil.rmtree('{}.thermograph'.format(new_file))
+        other_file = os.path.join(tempdir, 'other_progress.pkl')
+        new_data.save_data(output_file=other_file, durable=True, verbosity=-1)
+        assert savestate_util.SavableState(other_file).thermograph['run_01'] == {'__ref__': 'run_01'}
+
+
+def test_background_save():
+    def failed_commit(*args):
+        raise OSError('simulated failure')
+
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data.save_data()
+        saved_data.flush()
+        assert not [each_file for each_file in os.listdir(tempdir) if '.tmp.' in each_file]
+        check_ligands_data(savestate_util.SavableState(data_file).ligands_data)
+
+        commit_save = savestate_util._commit_save
+        try:
+            savestate_util._commit_save = failed_commit
+            # A failed background commit is raised by flush_pending_saves...
+            saved_data.save_data()
+            try:
+                saved_data.flush_pending_saves(verbosity=-1)
+            except OSError:
+                pass
+            else:
+                raise AssertionError('OSError of a background save not raised by flush_pending_saves')
+
+            # ... and by the next save
+            saved_data.save_data()
+            try:
+                saved_data.save_data(verbosity=-1)
+            except OSError:
+                pass
+            else:
+                raise AssertionError('OSError of a background save not raised by the next save_data')
+        finally:
+            savestate_util._commit_save = commit_save
+
+
+def test_compression():
+    zstandard = savestate_util.zstandard
+    try:
+        for each_module in ([zstandard, None] if zstandard is not None else [None]):
+            savestate_util.zstandard = each_module
+            with TemporaryDirectory() as tempdir:
+                data_file = os.path.join(tempdir, 'progress.pkl')
+                saved_data = savestate_util.SavableState(data_file)
+                saved_data['ligands_data'] = make_ligands_data()
+                saved_data.save_data(durable=True)
+                with open(data_file, 'rb') as fh:
+                    assert (fh.read(4) == savestate_util._ZSTD_MAGIC) == (each_module is not None)
+                check_ligands_data(savestate_util.SavableState(data_file).ligands_data)
+    finally:
+        savestate_util.zstandard = zstandard
+
+
+def test_missing_blob_file():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data.save_data(durable=True)
+        for each_file in os.listdir(tempdir):
+            if each_file.endswith('.blobs'):
+                os.remove(os.path.join(tempdir, each_file))
+        try:
+            savestate_util.SavableState(data_file, verbosity=-1)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised for a progress file without its blob file')
+
+
+def test_copied_progress_file():
+    with TemporaryDirectory() as tempdir:
+        data_file = os.path.join(tempdir, 'progress.pkl')
+        copy_file = os.path.join(tempdir, 'copy.pkl')
+        saved_data = savestate_util.SavableState(data_file)
+        saved_data['ligands_data'] = make_ligands_data()
+        saved_data.save_data(durable=True)
+
+        # A copy without its blob file fails right away
+        shutil.copy2(data_file, copy_file)
+        try:
+            savestate_util.SavableState(copy_file, verbosity=-1)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised for a copied progress file without its blob file')
+
+        # A copy along with its blob file is independent from the original
+        shutil.copy2('{}.blobs'.format(data_file), '{}.blobs'.format(copy_file))
+        saved_data.save_data(durable=True)
+        check_ligands_data(savestate_util.SavableState(copy_file).ligands_data)
+
+        # The blob file of another save is detected
+        shutil.copy2(data_file, copy_file)
+        try:
+            savestate_util.SavableState(copy_file, verbosity=-1)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised for a progress file with a mismatched blob file')
+
+
+def test_fast_copy():
+    def unsupported_copy(*args):
+        raise OSError('not supported')
+
+    with TemporaryDirectory() as tempdir:
+        source = os.path.join(tempdir, 'source.bin')
+        with open(source, 'wb') as fh:
+            fh.write(os.urandom(3 * 1024 * 1024 + 7))
+        os.chmod(source, 0o640)
+        os.utime(source, (1600000000, 1600000000))
+
+        kernel_functions = {each_name: getattr(os, each_name) for each_name in ['copy_file_range', 'sendfile']
+                            if hasattr(os, each_name)}
+        for each_case in ['kernel', 'fallback']:
+            destination = os.path.join(tempdir, '{}.bin'.format(each_case))
+            try:
+                if each_case == 'fallback':
+                    # Make the kernel space copies fail, so that copyfileobj is used
+                    for each_name in kernel_functions:
+                        setattr(os, each_name, unsupported_copy)
+                savestate_util._fast_copy(source, destination)
+            finally:
+                for each_name, each_function in kernel_functions.items():
+                    setattr(os, each_name, each_function)
+            with open(source, 'rb') as source_fh, open(destination, 'rb') as destination_fh:
+                assert source_fh.read() == destination_fh.read()
+            source_stat, destination_stat = os.stat(source), os.stat(destination)
+            assert source_stat.st_mode == destination_stat.st_mode
+            assert source_stat.st_mtime == destination_stat.st_mtime
+
+        # Copying a file onto itself must not truncate it
+        try:
+            savestate_util._fast_copy(source, os.path.join(tempdir, '.', 'source.bin'))
+        except shutil.SameFileError:
+            pass
+        else:
+            raise AssertionError('SameFileError not raised when copying a file onto itself')
+        assert os.path.getsize(source) == 3 * 1024 * 1024 + 7
+
+
+def test_perturbation_image_highlights():
+    class RecordingDrawer:
+        """ Stands for MolDraw2DSVG, recording the highlighted atoms """
+        highlights = []
+
+        def __init__(self, width, height):
+            self.draw_options = type('DrawOptions', (), {})()
+
+        def drawOptions(self):
+            return self.draw_options
+
+        def DrawMolecule(self, mol, legend='', highlightAtoms=None):
+            RecordingDrawer.highlights.append((legend, sorted(highlightAtoms if highlightAtoms else [])))
+
+        def FinishDrawing(self):
+            pass
+
+        def GetDrawingText(self):
+            return '<svg></svg>'
+
+    with TemporaryDirectory() as tempdir:
+        saved_data = savestate_util.SavableState(os.path.join(tempdir, 'progress.pkl'))
+        saved_data['ligands_data'] = {'phenol': {'molecule': rdkit.Chem.MolFromSmiles('c1ccccc1O')},
+                                      'toluene': {'molecule': rdkit.Chem.MolFromSmiles('Cc1ccccc1')}}
+        mol_draw_2d_svg = savestate_util.MolDraw2DSVG
+        try:
+            savestate_util.MolDraw2DSVG = RecordingDrawer
+            saved_data.update_pertubation_image('phenol', 'toluene', core_smarts='c1ccccc1')
+        finally:
+            savestate_util.MolDraw2DSVG = mol_draw_2d_svg
+
+    # Only the atoms outside the common core are highlighted, both with and without Hs
+    assert RecordingDrawer.highlights == [('phenol', [6]), ('phenol', [6]), ('toluene', [0]), ('toluene', [0])]
+    assert saved_data.ligands_data['phenol']['images']['perturbations']['toluene']['c1ccccc1'] == \
+           {'2d_hs': '<svg></svg>', '2d_nohs': '<svg></svg>'}
+
+
+def test_user_storage_backup_names():
+    with TemporaryDirectory() as tempdir:
+        storage_dir = savestate_util.UserStorageDirectory(tempdir)
+        storage_dir.create_file('settings.txt', 'contents')
+        storage_dir.flush()
+        backup_files = [each_file for each_file in os.listdir(storage_dir.path) if each_file != 'settings.txt']
+        assert len(backup_files) == 1
+        assert re.fullmatch(r'settings_\d{6}_\d{8}\.txt', backup_files[0])
+        with open(os.path.join(storage_dir.path, backup_files[0])) as fh:
+            assert fh.read() == 'contents'
+
+
+
+def test_user_storage_repeated_backups():
+    with TemporaryDirectory() as tempdir:
+        source_dir = os.path.join(tempdir, 'source_dir')
+        os.mkdir(source_dir)
+        with open(os.path.join(source_dir, 'data.txt'), 'w') as fh:
+            fh.write('contents')
+        storage_dir = savestate_util.UserStorageDirectory(tempdir)
+        # Backups made in the same second share a name
+        for _ in range(5):
+            storage_dir.store_file(source_dir)
+        storage_dir.flush()
+        backup_dirs = [each_file for each_file in os.listdir(storage_dir.path) if each_file != 'source_dir']
+        assert all(re.fullmatch(r'source_dir_\d{6}_\d{8}', each_dir) for each_dir in backup_dirs)
+        for each_dir in backup_dirs:
+            with open(os.path.join(storage_dir.path, each_dir, 'data.txt')) as fh:
+                assert fh.read() == 'contents'
+
+        # Same for files
+        for each_index in range(5):
+            storage_dir.create_file('settings.txt', 'contents {}'.format(each_index))
+        storage_dir.flush()
+        backup_files = [each_file for each_file in os.listdir(storage_dir.path) if each_file.startswith('settings_')]
+        assert all(re.fullmatch(r'settings_\d{6}_\d{8}\.txt', each_file) for each_file in backup_files)
+        with open(os.path.join(storage_dir.path, 'settings.txt')) as fh:
+            assert fh.read() == 'contents 4'
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Tests savestate_util.py')
+    parser.add_argument('tests', type=str, nargs='*',
+                        default=['read_legacy_file', 'save_and_load', 'incremental_save', 'incomplete_wal_record',
+                                 'blob_types', 'thermograph_runs', 'background_save', 'compression',
+                                 'missing_blob_file', 'copied_progress_file', 'fast_copy',
+                                 'perturbation_image_highlights', 'user_storage_backup_names',
+                                 'user_storage_repeated_backups'],
+                        help="Run these tests (default: run all tests)")
+    arguments = parser.parse_args()
+
+    for each_test in arguments.tests:
+        if each_test == 'read_legacy_file':
+            test_read_legacy_file()
+        elif each_test == 'save_and_load':
+            test_save_and_load()
+        elif each_test == 'incremental_save':
+            test_incremental_save()
+        elif each_test == 'incomplete_wal_record':
+            test_incomplete_wal_record()
+        elif each_test == 'blob_types':
+            test_blob_types()
+        elif each_test == 'thermograph_runs':
+            test_thermograph_runs()
+        elif each_test == 'background_save':
+            test_background_save()
+        elif each_test == 'compression':
+            test_compression()
+        elif each_test == 'missing_blob_file':
+            test_missing_blob_file()
+        elif each_test == 'copied_progress_file':
+            test_copied_progress_file()
+        elif each_test == 'fast_copy':
+            test_fast_copy()
+        elif each_test == 'perturbation_image_highlights':
+            test_perturbation_image_highlights()
+        elif each_test == 'user_storage_backup_names':
+            test_user_storage_backup_names()
+        elif each_test == 'user_storage_repeated_backups':
+            test_user_storage_repeated_backups()
+        else:
+            raise ValueError('Unknown test {}'.format(each_test))